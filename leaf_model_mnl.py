@@ -23,8 +23,57 @@
 #51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import numpy as np
-from leaf_model_mnl_tensorflow import *
-from leaf_model_mnl_rmnlogit import *
+
+#The tensorflow and rmnlogit backends are imported the first time they are needed (see LeafModel.fit),
+#since importing tensorflow and starting the embedded R interpreter are both expensive and a process
+#typically only ever fits one of the two. _BACKENDS maps leaf_mod_type -> backend class once imported.
+_BACKENDS = {}
+
+def _get_backend(leaf_mod_type):
+  backend = _BACKENDS.get(leaf_mod_type)
+  if backend is None:
+    if leaf_mod_type == "tensorflow":
+      from leaf_model_mnl_tensorflow import LeafModelTensorflow as backend
+    else:
+      from leaf_model_mnl_rmnlogit import LeafModelRMNLogit as backend
+    _BACKENDS[leaf_mod_type] = backend
+  return(backend)
+
+#tensorflow is used for leaves with more than leaf_mod_thresh observations, rmnlogit otherwise
+#(shared by LeafModel.fit and LeafModel.fit_batch)
+def _choose_leaf_mod_type(n_obs, leaf_mod_thresh):
+  return("tensorflow" if n_obs > leaf_mod_thresh else "rmnlogit")
+
+#Executors used by LeafModel.fit_batch, keyed by executor type (processes or threads) and holding
+#(n_jobs, executor). They are kept alive between calls so that each worker process only imports its
+#backend (and starts R) once; an executor is replaced when fit_batch is called with a different n_jobs.
+#Call shutdown_fit_batch_executors() to release them.
+_EXECUTORS = {}
+
+def _get_executor(use_processes, n_jobs):
+  entry = _EXECUTORS.get(use_processes)
+  if entry is not None and entry[0] == n_jobs:
+    return(entry[1])
+  if entry is not None:
+    entry[1].shutdown(wait=True)
+  from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+  if use_processes:
+    executor = ProcessPoolExecutor(max_workers=n_jobs)
+  else:
+    executor = ThreadPoolExecutor(max_workers=n_jobs)
+  _EXECUTORS[use_processes] = (n_jobs, executor)
+  return(executor)
+
+def shutdown_fit_batch_executors(wait=True):
+  for n_jobs, executor in _EXECUTORS.values():
+    executor.shutdown(wait=wait)
+  _EXECUTORS.clear()
+
+#fits a single LeafModel; defined at module level so that it can be sent to worker processes
+def _fit_leaf_model(A, Y, weights, fit_init, kwargs):
+  leaf_mod = LeafModel()
+  error = leaf_mod.fit(A, Y, weights, fit_init=fit_init, **kwargs)
+  return(leaf_mod, error)
 
 '''
 MST depends on the classes and functions below. 
@@ -88,7 +137,8 @@ class LeafModel(object):
   
   Any additional args passed to MST's fit() function are directly passed here
   '''
-  def fit(self, A, Y, weights, fit_init=None, leaf_mod_thresh=1000000, **kwargs):
+  def fit(self, A, Y, weights, fit_init=None, leaf_mod_thresh=1000000, tf_dtype=None,
+          num_features=None, loglik_proba_cap=None, **kwargs):
     
     '''
     There are two different implementations of fitting vanilla MNL models that are considered:
@@ -100,30 +150,101 @@ class LeafModel(object):
     
     If fit_init is provided, we warm-start the current leaf model fit with the coefficients from fit_init IF
     fit_init was trained using the same algorithm (tensorflow vs rmnlogit) as the current model under consideration.
+    
+    tf_dtype: optional dtype that A is cast to before being passed to the tensorflow implementation
+    (e.g., np.float32, which halves memory traffic relative to float64). Only set this if the tensorflow
+    implementation in use accepts A in that dtype. By default (None) A is passed as is. The rmnlogit
+    implementation always receives A unchanged, since R works in double precision.
+    
+    If all observations in the leaf made the same choice, neither implementation is called: the leaf
+    model is a _ConstantMNL which predicts that choice with probability one.
+    
+    num_features (number of features per alternative, so that A has num_features*n_items columns) and
+    loglik_proba_cap are forwarded to the tensorflow/rmnlogit implementation only if given, so that each
+    implementation otherwise applies its own defaults. _ConstantMNL uses num_features=4 and
+    loglik_proba_cap=0 when they are not given.
     '''
     
-    if (len(Y) > leaf_mod_thresh):
-      self.leaf_mod_type = "tensorflow"
-      if fit_init is not None and fit_init.leaf_mod_type == "tensorflow":
-        fit_init = fit_init.mnl
-      else:
-        fit_init = None
-      
-      if self.mnl is None:
-        self.mnl = LeafModelTensorflow()
+    #Y holds choice indices: convert once to a contiguous int32 array shared by the checks below and the backends
+    Y = np.ascontiguousarray(Y, dtype=np.int32)
     
+    if Y.shape[0] == 0:
+      return(1)
+    
+    if not are_Ys_diverse(Y):
+      self.leaf_mod_type = "constant"
+      self.mnl = _ConstantMNL(Y[0], int(A.shape[1]/(4 if num_features is None else num_features)),
+                              loglik_proba_cap=(0 if loglik_proba_cap is None else loglik_proba_cap))
+      return(0)
+    
+    leaf_mod_type = _choose_leaf_mod_type(Y.shape[0], leaf_mod_thresh)
+    self.leaf_mod_type = leaf_mod_type
+    if fit_init is not None and fit_init.leaf_mod_type == leaf_mod_type:
+      fit_init = fit_init.mnl
     else:
-      self.leaf_mod_type = "rmnlogit"
-      if fit_init is not None and fit_init.leaf_mod_type == "rmnlogit":
-        fit_init = fit_init.mnl
-      else:
-        fit_init = None
-      
-      if self.mnl is None:
-        self.mnl = LeafModelRMNLogit()
+      fit_init = None
+    
+    if leaf_mod_type == "tensorflow" and tf_dtype is not None:
+      A = np.asarray(A, dtype=tf_dtype)
     
+    backend = _get_backend(leaf_mod_type)
+    if not isinstance(self.mnl, backend):
+      self.mnl = backend()
+    
+    if num_features is not None:
+      kwargs["num_features"] = num_features
+    if loglik_proba_cap is not None:
+      kwargs["loglik_proba_cap"] = loglik_proba_cap
     error = self.mnl.fit(A, Y, weights, fit_init=fit_init, **kwargs)
     return(error)
+  
+  '''
+  Fits a separate LeafModel on each of several datasets in parallel (e.g., the candidate leaves of
+  the splits being evaluated at a node). The fits are independent of each other.
+  
+  datasets: list of (A, Y, weights) or (A, Y, weights, fit_init) tuples, where fit_init (optional)
+    is the warm start for that dataset's fit (see fit())
+  n_jobs: maximum number of workers per executor (None uses the concurrent.futures default)
+  Any additional args are passed to each fit() call.
+  
+  rmnlogit leaves are fit in worker processes since the embedded R interpreter is not thread-safe;
+  tensorflow leaves are fit in threads since tensorflow releases the GIL while training. Leaves in which
+  every observation made the same choice never reach either implementation and are fit inline.
+  All rmnlogit leaves are submitted before any tensorflow leaf, so that the worker processes are forked
+  before tensorflow threads start running in this process.
+  
+  The worker pools are reused across calls; call shutdown_fit_batch_executors() to release them
+  once no further batches will be fit.
+  
+  Returns a list of (LeafModel, error) pairs in the same order as datasets, where error is the
+  value returned by fit().
+  '''
+  @classmethod
+  def fit_batch(cls, datasets, n_jobs=None, leaf_mod_thresh=1000000, **kwargs):
+    kwargs["leaf_mod_thresh"] = leaf_mod_thresh
+    results = [None]*len(datasets)
+    process_jobs = []
+    thread_jobs = []
+    for i, dataset in enumerate(datasets):
+      A, Y, weights = dataset[:3]
+      fit_init = dataset[3] if len(dataset) > 3 else None
+      Y = np.asarray(Y)
+      if Y.shape[0] == 0 or not are_Ys_diverse(Y):
+        results[i] = _fit_leaf_model(A, Y, weights, fit_init, kwargs)
+      elif _choose_leaf_mod_type(Y.shape[0], leaf_mod_thresh) == "tensorflow":
+        thread_jobs.append((i, (A, Y, weights, fit_init, kwargs)))
+      else:
+        process_jobs.append((i, (A, Y, weights, fit_init, kwargs)))
+    
+    futures = []
+    for use_processes, jobs in ((True, process_jobs), (False, thread_jobs)):
+      if len(jobs) > 0:
+        executor = _get_executor(use_processes, n_jobs)
+        for i, args in jobs:
+          futures.append((i, executor.submit(_fit_leaf_model, *args)))
+    for i, future in futures:
+      results[i] = future.result()
+    return(results)
     
   '''
   This function applies model from fit() to predict response data given new data A.
@@ -176,6 +297,44 @@ class LeafModel(object):
     return(self.mnl.to_string(*leafargs,**leafkwargs))
     
 
+'''
+_ConstantMNL: leaf model used by LeafModel.fit when every observation in the leaf made the same choice.
+Predicts that choice with probability one, without calling either MNL implementation.
+If the choice is not offered in a given assortment, predicts uniformly over the offered alternatives.
+'''
+class _ConstantMNL(object):
+  
+  def __init__(self, only_choice, n_items, loglik_proba_cap=0):
+    self.only_choice = only_choice
+    self.n_items = n_items
+    self.loglik_proba_cap = loglik_proba_cap
+    return
+  
+  def predict(self, Anew, *args, **kwargs):
+    Ypred = np.zeros((Anew.shape[0],self.n_items))
+    Ypred[:,self.only_choice] = 1.0
+    
+    inds2correct = np.where(np.logical_not(Anew[:,self.only_choice]))[0]
+    if len(inds2correct) > 0:
+      avails = Anew[inds2correct,:self.n_items]
+      Ypred[inds2correct,:] = np.multiply(avails,(1.0/np.sum(avails,axis=1))[:,np.newaxis])
+    
+    return(Ypred)
+  
+  def error(self,A,Y):
+    Ypred = self.predict(A)
+    return(-np.log(np.maximum(Ypred[(np.arange(Y.shape[0]),Y)],self.loglik_proba_cap)))
+  
+  def error_pruning(self,A,Y):
+    Ypred = self.predict(A)
+    Z = np.zeros(Ypred.shape)
+    Z[(np.arange(Y.shape[0]),Y)] = 1.0
+    return(np.sum((Z-Ypred)**2.0,axis = 1))
+  
+  def to_string(self,*leafargs,**leafkwargs):
+    return("Model params: predicts choice " + str(self.only_choice) + " with prob. 1")
+    
+
 '''
 Given decision vars A, response data Y, and observation indices data_inds,
 extract those observations of A and Y corresponding to data_inds
@@ -183,19 +342,58 @@ extract those observations of A and Y corresponding to data_inds
 If only decision vars A is given, returns A.
 If only response data Y is given, returns Y.
 
-If is_boolvec=True, data_inds takes the form of a boolean vector which indicates
-the elements we wish to extract. Otherwise, data_inds takes the form of the indices
-themselves (i.e., ints).
+data_inds takes either the form of a boolean vector which indicates the elements we wish
+to extract, or the form of the indices themselves (i.e., ints). The form is determined from
+the dtype of data_inds; is_boolvec is accepted for compatibility but not relied upon.
+
+If the selected observations are consecutive (e.g., data_inds = [5,6,7,8]), the returned arrays
+are views of A and Y rather than copies.
 
 Used to partition the data in the tree-fitting procedure
 '''
 def get_sub(data_inds,A=None,Y=None,is_boolvec=False):
+  data_inds = np.asarray(data_inds)
+  if data_inds.dtype == bool:
+    #convert the mask to indices once so that A and Y are not each masked separately
+    data_inds = np.flatnonzero(data_inds)
+  else:
+    data_inds = np.asarray(data_inds, dtype=np.intp)
+  
+  #consecutive non-negative indices: slice instead of gathering (no copy). The cheap check on the first two
+  #indices avoids building np.arange when the indices are clearly not a range. Runs starting at a negative
+  #index (e.g., [-3,-2,-1] or [-2,-1,0]) count from the end of A and cannot be expressed as slice(start,stop).
+  #Runs extending past the last row are also left to np.take, which raises the out-of-bounds error
+  #(a slice would silently truncate them)
+  if data_inds.size > 1 and data_inds[0] >= 0 and data_inds[1] - data_inds[0] == 1:
+    start, stop = int(data_inds[0]), int(data_inds[-1]) + 1
+    n_rows = min(len(X) for X in (A,Y) if X is not None)
+    if stop <= n_rows and stop - start == data_inds.size and np.array_equal(data_inds, np.arange(start,stop)):
+      rows = slice(start,stop)
+      if A is None:
+        return Y[rows]
+      if Y is None:
+        return A[rows]
+      else:
+        return A[rows],Y[rows]
+  
   if A is None:
-    return Y[data_inds]
+    return np.take(Y,data_inds,axis=0)
   if Y is None:
-    return A[data_inds]
+    return np.take(A,data_inds,axis=0)
   else:
-    return A[data_inds],Y[data_inds]  
+    return np.take(A,data_inds,axis=0),np.take(Y,data_inds,axis=0)
+
+'''
+Given the observation indices parent_inds of a node and a boolean vector go_left (one entry per
+element of parent_inds) indicating which of those observations a candidate split sends to the left child,
+returns the data of both children: ((A_left, Y_left), (A_right, Y_right)).
+
+Equivalent to calling get_sub() on parent_inds[go_left] and parent_inds[~go_left].
+'''
+def get_sub_split(parent_inds,go_left,A,Y):
+  left_inds = parent_inds[go_left]
+  right_inds = parent_inds[np.logical_not(go_left)]
+  return(get_sub(left_inds,A,Y), get_sub(right_inds,A,Y))
 
 '''
 This function takes as input response data Y and outputs a boolean corresponding
@@ -207,5 +405,12 @@ max depth, etc), we will consider splitting on the node. If you do not want to s
 termination criterion, simply "return True"
 '''
 def are_Ys_diverse(Y):
-  return (len(np.unique(Y)) > 1)
+  #avoid np.unique, which sorts all of Y. Integer choices are diverse iff min != max, which needs
+  #no temporary array; other responses are compared against the first response
+  Y = np.asarray(Y)
+  if Y.size <= 1:
+    return False
+  if Y.dtype.kind in 'biu':
+    return bool(Y.min() != Y.max())
+  return bool(np.any(Y != Y.flat[0]))
 
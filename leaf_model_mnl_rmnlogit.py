@@ -29,6 +29,10 @@ importr('mnlogit')
 pandas2ri.activate()
 ro.r.source("newmnlogit.R") #rewrites some functions from the mnlogit package to accommodate varying choice sets
 
+#look up the R functions once (after newmnlogit.R has been sourced) rather than on every fit/predict call
+_r_mnlogit = ro.r['mnlogit']
+_r_predict = ro.r['predict']
+
 '''
 MST depends on the classes and functions below. 
 These classes/methods are used to define the leaf model object in each leaf node,
@@ -120,10 +124,12 @@ class LeafModelRMNLogit(object):
       if model_type == 1 and is_bias == False:
         selected_alts = np.in1d(range(n_items),range(n_items))
         self.selected_alts = selected_alts
+        self.selected_cols = np.tile(selected_alts,num_features)
       else:
         selected_alts = np.in1d(range(n_items),Y)
-        A = A[:,np.tile(selected_alts,num_features)]
-        self.selected_alts = selected_alts      
+        self.selected_alts = selected_alts
+        self.selected_cols = np.tile(selected_alts,num_features)
+        A = A[:,self.selected_cols]
         Y = pd.factorize(Y,sort=True)[0]
       
       if len(np.unique(Y)) == 1:
@@ -148,23 +154,42 @@ class LeafModelRMNLogit(object):
         else:
           form = "choice ~ " + prod_feat_str + "+ Avl" + "|" + str(int(is_bias))
       
+      weights_all_same = len(np.unique(weights)) == 1
+      if weights_all_same:
+        mnlogit_kwargs = {}
+      else:
+        mnlogit_kwargs = {'weights': ro.FloatVector(weights)}
+      
+      #warm-start from fit_init's coefficients if it was fit on the same set of alternatives
+      #(mnlogit matches the coefficients by name and falls back to a cold start if they do not line up).
+      #A cold start sets all coefficients to zero except the availability coefficient "Avl", i.e. it starts
+      #from uniform choice probabilities over the offered alternatives (see newtonRaphson in newmnlogit.R)
+      start_kwargs = dict(mnlogit_kwargs)
+      if fit_init is not None and fit_init.model_fit == True and fit_init.mymnl is not None \
+         and np.array_equal(fit_init.selected_alts, selected_alts):
+        init_coefs = fit_init.get_coefs().dropna()
+        start = ro.FloatVector(init_coefs.values)
+        start.names = ro.StrVector(list(init_coefs.index))
+        start_kwargs['start'] = start
+      
       try:
-        weights_all_same = len(np.unique(weights)) == 1
-        if weights_all_same:
-          mymnl = ro.r.mnlogit(ro.Formula(form), data=ro.DataFrame(df_long), choiceVar='alt')
-        else:
-          mymnl = ro.r.mnlogit(ro.Formula(form), data=ro.DataFrame(df_long), choiceVar='alt', weights=ro.FloatVector(weights))
+        mymnl = _r_mnlogit(get_formula(form), data=ro.DataFrame(df_long), choiceVar='alt', **start_kwargs)
       except:
+        mymnl = None
+        if 'start' in start_kwargs:
+          #the warm start may be at fault: first retry with a cold start on the unperturbed data
+          try:
+            mymnl = _r_mnlogit(get_formula(form), data=ro.DataFrame(df_long), choiceVar='alt', **mnlogit_kwargs)
+          except:
+            mymnl = None
+      if mymnl is None:
         #fitting issue likely due to features being linear combinations of each other.
         #try adding random noise to each feature and refitting
         df_long['Avl'] = df_long['Avl'] + np.random.uniform(low=-0.001, high=0.001, size=len(df_long['Avl']))
         for f in range(1,num_features):
           fname = 'F'+str(f)
           df_long[fname] = df_long[fname] + np.random.uniform(low=-0.001, high=0.001, size=len(df_long[fname]))
-        if weights_all_same:
-          mymnl = ro.r.mnlogit(ro.Formula(form), data=ro.DataFrame(df_long), choiceVar='alt')
-        else:
-          mymnl = ro.r.mnlogit(ro.Formula(form), data=ro.DataFrame(df_long), choiceVar='alt', weights=ro.FloatVector(weights))
+        mymnl = _r_mnlogit(get_formula(form), data=ro.DataFrame(df_long), choiceVar='alt', **mnlogit_kwargs)
       #print(ro.r.summary(mymnl)) #see summary statistics for fit
       
       self.mymnl = mymnl
@@ -177,6 +202,17 @@ class LeafModelRMNLogit(object):
       return(1)
 
     
+  '''
+  Returns the fitted mnlogit coefficients as a pandas Series indexed by coefficient name,
+  or None if the model predicts a single choice (no coefficients were fit).
+  Used to warm-start subsequent fits (see fit_init in fit()).
+  '''
+  def get_coefs(self):
+    if self.mymnl is None:
+      return(None)
+    coefs = self.mymnl.rx2('coefficients')
+    return(pd.Series(np.array(coefs), index=list(coefs.names)))
+  
   '''
   This function applies model from fit() to predict response data given new data A.
   Returns a numpy vector/matrix of response probabilities (one list entry per observation, i.e. l[i] yields prediction for ith obs.).
@@ -185,6 +221,14 @@ class LeafModelRMNLogit(object):
   Any additional args passed to MST's predict() function are directly passed here
   '''
   def predict(self, Anew, *args,**kwargs):
+    return(self._predict(Anew))
+  
+  '''
+  Shared implementation of predict() and error(). If utilities=True, returns the matrix of
+  MNL utilities (log-probabilities up to a per-observation constant) rather than probabilities;
+  alternatives predicted with probability 0 have utility -inf.
+  '''
+  def _predict(self, Anew, utilities=False):
     
     #bug in current predict function which doesn't allow Anew to be a single observation.
     #hack fix: duplicate it into two observations
@@ -211,9 +255,16 @@ class LeafModelRMNLogit(object):
         n_items = int(Anew.shape[1]/self.num_features)
         Ypred[inds2correct,:] = np.multiply(Anew[inds2correct,:n_items],(1.0/np.sum(Anew[inds2correct,:n_items],axis=1))[:,np.newaxis])
       
+      if utilities:
+        with np.errstate(divide='ignore'):
+          Ypred = np.log(Ypred)
+      
+      if Anew_singleton is True:
+        Ypred = Ypred[0,None]
+      
       return(Ypred)
     
-    A = Anew[:,np.tile(self.selected_alts,self.num_features)] #take away attributes to match fit() dataset
+    A = Anew[:,self.selected_cols] #take away attributes to match fit() dataset
     
     num_selected_alts = sum(self.selected_alts)
     if not np.all(np.sum(A[:,:num_selected_alts],axis=1)):
@@ -225,15 +276,18 @@ class LeafModelRMNLogit(object):
     
     df_long = data2long_format(A, num_features=self.num_features)
     
-    Ypred = np.array(ro.r.predict(self.mymnl, newdata=ro.DataFrame(df_long), choiceVar='alt'))
+    Ypred = np.array(_r_predict(self.mymnl, newdata=ro.DataFrame(df_long), choiceVar='alt', probability=not utilities))
     
     #add back in missing attributes with predicted probabilities of 0.0
-    Ypred2 = np.zeros((Ypred.shape[0],len(self.selected_alts)))
+    Ypred2 = np.full((Ypred.shape[0],len(self.selected_alts)), -np.inf if utilities else 0.0)
     Ypred2[:,self.selected_alts] = Ypred
     
     if inds2correct is not None:
       n_items = int(Anew.shape[1]/self.num_features)
       Ypred2[inds2correct,:] = np.multiply(Anew[inds2correct,:n_items],(1.0/np.sum(Anew[inds2correct,:n_items],axis=1))[:,np.newaxis])
+      if utilities:
+        with np.errstate(divide='ignore'):
+          Ypred2[inds2correct,:] = np.log(Ypred2[inds2correct,:])
     
     if Anew_singleton is True:
       Ypred2 = Ypred2[0,None]
@@ -254,8 +308,18 @@ class LeafModelRMNLogit(object):
   '''
   def error(self,A,Y):
     loglik_proba_cap = self.loglik_proba_cap
-    Ypred = self.predict(A)
-    log_probas = -np.log(np.maximum(Ypred[(np.arange(Y.shape[0]),Y)],loglik_proba_cap))
+    #compute -log P(chosen) = log(1 + sum_{j != chosen} exp(v_j - v_chosen)) directly from the utilities v,
+    #rather than normalizing all probabilities and then selecting the chosen one
+    U = self._predict(A, utilities=True)
+    obs_inds = (np.arange(Y.shape[0]),Y)
+    U_chosen = U[obs_inds]
+    with np.errstate(over='ignore', invalid='ignore'):
+      U_diff = U - U_chosen[:,np.newaxis]
+      U_diff[obs_inds] = -np.inf
+      log_probas = np.log1p(np.sum(np.exp(U_diff),axis=1))
+    log_probas[np.isneginf(U_chosen)] = np.inf #chosen alternative predicted with probability 0
+    if loglik_proba_cap > 0:
+      log_probas = np.minimum(log_probas,-np.log(loglik_proba_cap))
     return(log_probas)
   
   '''
@@ -297,6 +361,17 @@ class LeafModelRMNLogit(object):
 functions for assistance to leaf model class
 '''
 
+#R formula objects used in fit(), keyed by formula string. Only a handful of distinct formulas occur
+#(one per num_features/model_type/is_bias combination), so each one is only built once per process
+_FORMULAS = {}
+
+def get_formula(form):
+  formula = _FORMULAS.get(form)
+  if formula is None:
+    formula = ro.Formula(form)
+    _FORMULAS[form] = formula
+  return(formula)
+
 def check_columns_oneunqval(A):
   return np.any(np.all(A == A[0,:], axis = 0))
 
@@ -320,21 +395,26 @@ def data2long_format(A, Y=None, num_features=2, weights=None):
       #Adummy = np.concatenate((np.ones(n_items),Adummy))
       #A = np.vstack((A,Adummy))
     
+  #reorder A from (obs, feature, item) to (feature, obs, item) in a single copy;
+  #row f of A_long is then feature f in long format
+  n_obs = A.shape[0]
+  A_long = np.ascontiguousarray(A.reshape(n_obs,num_features,n_items).transpose(1,0,2)).reshape(num_features,-1)
+  
   df_long = {}
   for f in range(0,num_features):
-    A_long_f = A[:,(n_items*f):(n_items*(f+1))].reshape(-1)
+    A_long_f = A_long[f]
     if f == 0:
       fname = 'Avl'
     else:
       fname = 'F'+str(f)
     df_long[fname] = A_long_f
   
-  alt = np.tile(range(1,n_items+1), A.shape[0])
+  alt = np.tile(np.arange(1,n_items+1), n_obs)
   df_long['alt'] = alt
   
   if Y is not None:
-    choice = np.zeros((A.shape[0],n_items), dtype=bool)
-    choice[(range(A.shape[0]),Y)] = True
+    choice = np.zeros((n_obs,n_items), dtype=bool)
+    choice[(np.arange(n_obs),Y)] = True
     choice = choice.reshape(-1)
   
     df_long['choice'] = choice